@@ -1,6 +1,7 @@
 """CPU functionality."""
 
 import sys
+from functools import partial
 
 ## ALU ops
 ADD = 0b10100000
@@ -42,20 +43,43 @@ POP  = 0b01000110
 PRN  = 0b01000111
 PRA  = 0b01001000
 
+## Instruction layout, AABCDDDD: operand count, is ALU, sets PC, identifier
+INST_LEN = tuple((op >> 6) + 1 for op in range(256))
+IS_ALU   = tuple(bool((op >> 5) & 1) for op in range(256))
+SETS_PC  = tuple(bool((op >> 4) & 1) for op in range(256))
+
+## Python source compiled inline into blocks instead of a handler call. Each line
+## mirrors the handler method of the same name and must be kept in step with it.
+BLOCK_SOURCE = {
+  LDI: "reg[{a}] = {b}",
+  ADD: "reg[{a}] = (reg[{a}] + reg[{b}]) & 0xFF",
+  MUL: "reg[{a}] = (reg[{a}] * reg[{b}]) & 0xFF",
+  AND: "reg[{a}] &= reg[{b}]",
+  OR:  "reg[{a}] |= reg[{b}]",
+  XOR: "reg[{a}] ^= reg[{b}]",
+  NOT: "reg[{a}] = ~reg[{a}] & 0xFF",
+  SHL: "reg[{a}] = (reg[{a}] << reg[{b}]) & 0xFF",
+  SHR: "reg[{a}] >>= reg[{b}]",
+  CMP: "self.flag = 0b00000001 if reg[{a}] == reg[{b}] else 0b00000010 if reg[{a}] > reg[{b}] else 0b00000100",
+}
+
+## Instructions that store to RAM. A block ends after them, since the store may have overwritten the block's own code
+WRITES_RAM = (PUSH, CALL)
+
 class CPU:
     """Main CPU class."""
 
     def __init__(self):
         """Construct a new CPU."""
-        self.register = [0] * 8  # 8 general-purpose CPU registers
-        self.ram = [0] * 256  # 256 bytes of memory (RAM)
+        self.register = bytearray(8)  # 8 general-purpose CPU registers, 8 bits each
+        self.ram = bytearray(256)  # 256 bytes of memory (RAM)
 
         self.pc = 0 # Program Counter, address of the currently executing instruction
         self.register[7] = 0xF4 # R7 is the SP
         self.flag = 0b00000000
         self.running = True
 
-        self.branch_table = {
+        handlers = {
           LDI: self.LDI,
           PRN: self.PRN,
           MUL: self.MUL,
@@ -77,42 +101,162 @@ class CPU:
           JNE: self.jne
         }
 
+        self.branch_table = [None] * 256 # Handler per opcode, None if unsupported. PC-setting handlers also take the PC and return the next one
+        for opcode, handler in handlers.items():
+          self.branch_table[opcode] = handler
+
+        self.blocks = [None] * 256 # Compiled block per start address
+        self.compiled = bytearray(256) # 1 for every address read by a compiled block
+
 
     def ram_read(self, address):
+      """ Return the value stored at the given address. """
       return self.ram[address]
 
     def ram_write(self, address, value):
+      """ Store a value at the given address, throwing away any compiled block that read it. """
       self.ram[address] = value
+      self.invalidate(address)
 
     def load(self, filename):
         """Load a program into memory."""
 
-        address = 0
-
         with open(filename, 'r') as f:
-            for line in f.readlines():
-                line = line.split('#')[0].strip()
-                if line.startswith(('0', '1')) and len(line) == 8:
-                    instruction = int(line, 2)
-                    self.ram_write(address, instruction)
-                    address += 1
+            lines = (line.split('#')[0].strip() for line in f)
+            bits = ''.join(line for line in lines if line.startswith(('0', '1')) and len(line) == 8)
+
+        # Convert the whole program in one int() call instead of one per byte
+        size = len(bits) // 8
+        if size > len(self.ram):
+            raise Exception("Program does not fit in memory")
+
+        if size:
+            self.ram[:size] = int(bits, 2).to_bytes(size, 'big')
+
+        self.blocks = [None] * 256
+        self.compiled = bytearray(256)
+
+    def decode(self, address):
+        """
+        Decode the instruction at the given address into a (handler, operand_a,
+        operand_b, inst_len, sets_pc) entry.
+        """
+
+        ir = self.ram[address]
+        inst_len = INST_LEN[ir]
+
+        # Only read the operand bytes the instruction has; missing operands are 0
+        operand_a = self.ram[(address + 1) & 0xFF] if inst_len > 1 else 0
+        operand_b = self.ram[(address + 2) & 0xFF] if inst_len > 2 else 0
+
+        return (self.branch_table[ir], operand_a, operand_b, inst_len, SETS_PC[ir])
+
+    def block_at(self, pc):
+        """ Return the compiled block that starts at pc, compiling it on first use. """
+        block = self.blocks[pc] = self.compile_block(pc)
+        return block
+
+    def compile_block(self, start):
+        """
+        Compile the straight-line instructions from start up to and including
+        the first one that sets the PC into a Python function. The function
+        runs them, then looks up and returns the block for the next PC, so
+        run() only has to call whatever block it gets back.
+
+        This is also where CMP fuses with a following JEQ or JNE: the compare
+        is pasted inline and the branch ends the block, so the pair costs one
+        handler call and one block dispatch.
+        """
+
+        namespace = {'self': self, 'reg': self.register, 'blocks': self.blocks, 'block_at': self.block_at}
+        lines = []
+        pc = start
+        size = 0 # Bytes compiled so far, so straight-line code that wraps all of RAM still ends
+
+        if self.branch_table[self.ram[pc]] is None:
+          self.compiled[pc] = 1
+          return partial(self.stop, pc)
+
+        while True:
+          handler, operand_a, operand_b, inst_len, sets_pc = self.decode(pc)
+
+          if handler is None:
+            lines.append(f"return blocks[{pc}] or block_at({pc})")
+            break
+
+          for offset in range(inst_len):
+            self.compiled[(pc + offset) & 0xFF] = 1
+
+          ir = self.ram[pc]
+          if not sets_pc and ir in BLOCK_SOURCE:
+            lines.append(BLOCK_SOURCE[ir].format(a=operand_a, b=operand_b))
+            pc = (pc + inst_len) & 0xFF
+            size += inst_len
+
+            if size >= 256:
+              lines.append(f"return blocks[{pc}] or block_at({pc})")
+              break
+            continue
+
+          namespace[f"h{pc}"] = handler
+
+          if sets_pc:
+            lines.append(f"pc = h{pc}({pc}, {operand_a}, {operand_b})")
+            lines.append("return blocks[pc] or block_at(pc)")
+            break
+
+          lines.append(f"h{pc}({operand_a}, {operand_b})")
+
+          pc = (pc + inst_len) & 0xFF
+          size += inst_len
+
+          if ir in WRITES_RAM or size >= 256:
+            lines.append(f"return blocks[{pc}] or block_at({pc})")
+            break
+
+        params = ", ".join(f"{name}={name}" for name in namespace)
+        source = f"def block({params}):\n" + "".join(f"  {line}\n" for line in lines)
+        exec(source, namespace)
+
+        return namespace['block']
+
+    def stop(self, pc):
+        """ Stop at an instruction without a handler: HLT, or an unsupported opcode. """
+        self.pc = pc
+        ir = self.ram[pc]
+
+        if ir == HLT:
+          self.running = False
+        elif IS_ALU[ir]:
+          raise Exception("Unsupported ALU operation")
+        else:
+          print(f"Invalid instructions {bin(ir)}")
+
+        return None
+
+    def invalidate(self, address):
+      """ Throw away all compiled blocks if the given address was compiled into one. """
+      if self.compiled[address]:
+        self.blocks[:] = [None] * 256 # In place, compiled blocks hold a reference
+        self.compiled[:] = bytes(256)
 
 
     def alu(self, op, register_a, register_b):
         """ ALU operations. """
 
-        if op in self.branch_table:
-          self.branch_table[op](register_a, register_b)
+        handler = self.branch_table[op]
+        if handler is not None:
+          handler(register_a, register_b)
         else:
             raise Exception("Unsupported ALU operation")
 
     def ADD(self, register_a, register_b):
       """ Add the value in two registers and store the result in registerA """
-      self.register[register_a] += self.register[register_b]
+      self.register[register_a] = (self.register[register_a] + self.register[register_b]) & 0xFF
 
     def MUL(self, register_a, register_b):
       """ Multiply the values in two registers together and store the result in registerA. """
-      self.register[register_a] *= self.register[register_b]
+      self.register[register_a] = (self.register[register_a] * self.register[register_b]) & 0xFF
 
     def AND(self, register_a, register_b):
       """ Bitwise-AND the values in registerA and registerB, then store the result in registerA. """
@@ -128,11 +272,11 @@ class CPU:
 
     def NOT(self, register_a, register_b):
       """ Perform a bitwise-NOT on the value in a register, storing the result in the register. """
-      self.register[register_a] = ~self.register[register_a]
+      self.register[register_a] = ~self.register[register_a] & 0xFF
 
     def SHL(self, register_a, register_b):
       """ Shift the value in registerA left by the number of bits specified in registerB, filling the low bits with 0. """
-      self.register[register_a] = self.register[register_a] << self.register[register_b]
+      self.register[register_a] = (self.register[register_a] << self.register[register_b]) & 0xFF
 
     def SHR(self, register_a, register_b):
       """ Shift the value in registerA right by the number of bits specified in registerB, filling the high bits with 0. """
@@ -156,120 +300,92 @@ class CPU:
         self.flag = 0b00000100
       # print(bin(self.flag))
 
-    def LDI(self):
+    def LDI(self, reg_number, value):
       """ Set the value of a register to an integer. """
-      reg_number = self.ram_read(self.pc + 1)
-      value = self.ram_read(self.pc + 2)
-
       self.register[reg_number] = value
 
-    def PRN(self):
+    def PRN(self, reg_number, _):
       """ Print numeric value stored in the given register. """
-      reg_number = self.ram_read(self.pc + 1)
       print(self.register[reg_number])
 
-    def push(self):
+    def push(self, reg_number, _):
       """ Push the value in the given register on the stack. """
-      self.register[7] -= 1
-      self.ram_write(self.register[7], self.register[self.ram_read(self.pc + 1)])
-      self.pc = self.pc + 2
-      reg_number = self.ram_read(self.pc + 1)
-      self.ram_write(self.register[7], self.register[reg_number])
+      sp = (self.register[7] - 1) & 0xFF
+      self.register[7] = sp
+      self.ram[sp] = self.register[reg_number]
 
-    def pop(self):
+      if self.compiled[sp]:
+        self.invalidate(sp)
+
+    def pop(self, reg_number, _):
       """ Pop the value at the top of the stack into the given register. """
-      self.register[self.ram_read(self.pc + 1)] = self.ram_read(self.register[7])
-      self.register[7] += 1
-      self.pc = self.pc + 2
+      sp = self.register[7]
+      self.register[reg_number] = self.ram[sp]
+      self.register[7] = (sp + 1) & 0xFF
 
-    def jmp(self):
+    def jmp(self, pc, reg_number, _):
       """ Jump to the address stored in the given register. """
-      reg_number = self.ram_read(self.pc + 1)
-      self.pc = self.register[reg_number]
+      return self.register[reg_number]
 
-    def jeq(self):
+    def jeq(self, pc, reg_number, _):
       """ If equal flag is set (true), jump to the address stored in the given register. """
-      reg_number = self.ram_read(self.pc + 1)
-      equal = self.flag & 0b00000001
-      # print(self.flag & 0b1)
-      if equal:
-        # print('It equals 1')
-        self.pc = self.register[reg_number]
-      else:
-        self.pc += 2
+      if self.flag & 0b00000001:
+        return self.register[reg_number]
+      return (pc + 2) & 0xFF
 
-    def jne(self):
+    def jne(self, pc, reg_number, _):
       """ If E flag is clear (false, 0), jump to the address stored in the given register. """
-      reg_number = self.ram_read(self.pc + 1)
-      equal = self.flag & 0b00000001
-      if not equal:
-        # print('It equals 0')
-        self.pc = self.register[reg_number]
-      else:
-        self.pc += 2
+      if not self.flag & 0b00000001:
+        return self.register[reg_number]
+      return (pc + 2) & 0xFF
 
-    def call(self, reg_number, value):
+    def call(self, pc, reg_number, _):
       """ Calls a subroutine (function) at the address stored in the register. """
-      self.register[7] -= 1
-      sp = self.register[7]
-      self.ram_write(value, sp)
+      sp = (self.register[7] - 1) & 0xFF
+      self.register[7] = sp
+      self.ram[sp] = (pc + 2) & 0xFF # Return address, the instruction after CALL
 
-      value = self.register[reg_number]
+      if self.compiled[sp]:
+        self.invalidate(sp)
 
-    def ret(self):
+      return self.register[reg_number]
+
+    def ret(self, pc, _a, _b):
       """ Return from subroutine. """
       sp = self.register[7]
-      self.pc = self.ram_read(sp)
-      self.register[7] += 1
+      self.register[7] = (sp + 1) & 0xFF
+      return self.ram[sp]
 
-    def trace(self):
+    def trace(self, pc=None):
         """
         Handy function to print out the CPU state. You might want to call this
         from run() if you need help debugging.
+
+        self.pc is only updated when the CPU stops, so when calling this from a
+        handler pass the pc that handler was given.
         """
 
+        if pc is None:
+            pc = self.pc
+
         print(f"TRACE: %02X | %02X %02X %02X |" % (
-            self.pc,
+            pc,
             #self.fl,
             #self.ie,
-            self.ram_read(self.pc),
-            self.ram_read(self.pc + 1),
-            self.ram_read(self.pc + 2)
+            self.ram_read(pc),
+            self.ram_read((pc + 1) & 0xFF),
+            self.ram_read((pc + 2) & 0xFF)
         ), end='')
 
         for i in range(8):
-            print(" %02X" % self.reg[i], end='')
+            print(" %02X" % self.register[i], end='')
 
         print()
 
     def run(self):
         """Run the CPU."""
 
-        while self.running:
-          ir = self.ram_read(self.pc) # Instruction Register, contains a copy of the currently executing instruction
-          # print(bin(ir))
-          inst_len = (ir >> 6) + 0b1
-          is_ALU = (ir & 0b00100000) >> 5 == 0b1
-          sets_pc = (ir & 0b00010000) >> 4 == 0b1
-
-          register_a = self.ram_read(self.pc+1)
-          register_b = self.ram_read(self.pc+2)
-
-          if is_ALU:
-            self.alu(ir, register_a, register_b)
-
-          elif ir in self.branch_table:
-            self.branch_table[ir]()
-
-          elif ir == HLT: # Halt
-            self.running = False
-
-          else:
-            print(f"Invalid instructions {bin(ir)}")
-            break
-
-          if not sets_pc:
-            self.pc += inst_len
-
-
+        block = self.blocks[self.pc] or self.block_at(self.pc)
 
+        while block:
+          block = block()
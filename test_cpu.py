@@ -0,0 +1,162 @@
+"""Tests for the LS-8 CPU. Run with: python -m unittest"""
+
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+from cpu import *
+
+
+def run(cpu):
+    """ Run the CPU and return everything it printed. """
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        cpu.run()
+    return output.getvalue()
+
+
+def load_source(cpu, source):
+    """ Write source to a temporary .ls8 file and load it into the CPU. """
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'program.ls8')
+        with open(filename, 'w') as f:
+            f.write(source)
+        cpu.load(filename)
+
+
+def run_program(program):
+    """ Load a list of bytes at address 0, run it, and return the printed output. """
+    cpu = CPU()
+    cpu.ram[:len(program)] = bytes(program)
+    return run(cpu)
+
+
+class CPUTest(unittest.TestCase):
+
+    def test_sctest(self):
+        cpu = CPU()
+        cpu.load(os.path.join(os.path.dirname(__file__), 'sctest.ls8'))
+        self.assertEqual(run(cpu), "1\n4\n5\n")
+
+    def test_load_parses_program_lines_only(self):
+        cpu = CPU()
+        load_source(cpu, "# Comment\n\n10000010 # LDI R0,255\n00000000\n11111111\n00000001\n")
+        self.assertEqual(cpu.ram[:5], bytes([LDI, 0, 255, HLT, 0]))
+
+    def test_load_rejects_program_larger_than_memory(self):
+        cpu = CPU()
+        with self.assertRaisesRegex(Exception, "Program does not fit in memory"):
+            load_source(cpu, "00000000\n" * 257)
+
+    def test_load_empty_program(self):
+        cpu = CPU()
+        cpu.ram[0] = HLT
+        load_source(cpu, "# No program lines\n\n")
+        self.assertEqual(cpu.ram, bytearray([HLT]) + bytearray(255))
+
+    def test_push_pop(self):
+        program = [
+          LDI, 0, 5,
+          LDI, 1, 7,
+          PUSH, 0,
+          PUSH, 1,
+          POP, 2,
+          POP, 3,
+          PRN, 2,
+          PRN, 3,
+          HLT,
+        ]
+        self.assertEqual(run_program(program), "7\n5\n")
+
+    def test_call_ret(self):
+        program = [
+          LDI, 1, 8,  # Address of the subroutine
+          CALL, 1,
+          PRN, 0,
+          HLT,
+          LDI, 0, 99, # Subroutine (address 8)
+          RET,
+        ]
+        self.assertEqual(run_program(program), "99\n")
+
+    def test_push_overwrites_code_later_in_the_same_block(self):
+        program = [
+          LDI, 7, 13, # SP at 13, so the PUSH below writes address 12
+          LDI, 0, 2,
+          PUSH, 0,    # Turns the first PRN R1 into PRN R2
+          LDI, 1, 9,
+          PRN, 1,     # Address 11, operand at 12
+          PRN, 1,
+          HLT,
+        ]
+        self.assertEqual(run_program(program), "0\n9\n")
+
+    def test_push_overwrites_code_already_compiled(self):
+        program = [
+          LDI, 0, 2,
+          LDI, 1, 9,
+          LDI, 2, 42, # Address of HLT
+          LDI, 3, 30, # Address of the PRN
+          LDI, 4, 25, # Address of the PUSH
+          LDI, 6, 1,
+          LDI, 7, 32, # SP at 32, so the PUSH writes the PRN's operand at 31
+          JMP, 3,
+          NOP, NOP,
+          PUSH, 0,    # Address 25
+          JMP, 3,
+          NOP,
+          PRN, 1,     # Address 30; prints R1 the first time, R2 after the PUSH
+          CMP, 5, 6,
+          JEQ, 2,
+          LDI, 5, 1,
+          JMP, 4,
+          HLT,        # Address 42
+        ]
+        self.assertEqual(run_program(program), "9\n42\n")
+
+    def test_pc_wraps_at_end_of_memory(self):
+        cpu = CPU()
+        cpu.ram[253:256] = bytes([LDI, 1, 7])
+        cpu.ram[0:5] = bytes([PRN, 1, JEQ, 1, HLT]) # E flag is clear, so JEQ falls through
+        cpu.pc = 253
+        self.assertEqual(run(cpu), "7\n")
+        self.assertFalse(cpu.running)
+
+    def test_branch_not_taken_at_end_of_memory(self):
+        cpu = CPU()
+        cpu.ram[254:256] = bytes([JEQ, 0])
+        cpu.ram[0] = HLT
+        cpu.pc = 254
+        run(cpu)
+        self.assertEqual(cpu.pc, 0)
+        self.assertFalse(cpu.running)
+
+    def test_block_source_matches_handlers(self):
+        for opcode, source in BLOCK_SOURCE.items():
+            for a, b in [(0, 0), (1, 2), (200, 100), (255, 7), (9, 3)]:
+                inline, handled = CPU(), CPU()
+                for cpu in inline, handled:
+                    cpu.register[0], cpu.register[1] = a, b
+
+                exec(source.format(a=0, b=1), {'self': inline, 'reg': inline.register})
+                handled.branch_table[opcode](0, 1)
+
+                self.assertEqual((inline.register, inline.flag), (handled.register, handled.flag), bin(opcode))
+
+    def test_alu_wraps_to_8_bits(self):
+        program = [
+          LDI, 0, 200,
+          LDI, 1, 100,
+          ADD, 0, 1,
+          PRN, 0,
+          NOT, 1,
+          PRN, 1,
+          HLT,
+        ]
+        self.assertEqual(run_program(program), "44\n155\n")
+
+
+if __name__ == '__main__':
+    unittest.main()